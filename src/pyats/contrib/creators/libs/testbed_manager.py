@@ -1,43 +1,191 @@
+import time
+import json
 import logging
 import argparse
 import ipaddress
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from genie.conf.base import Testbed, Device, Interface, Link
-from pyats.async_ import pcall
+from genie.metaparser.util.exceptions import SchemaEmptyParserError
 from pyats.log import TaskLogHandler
 from pyats.log import ScreenHandler
 
 log = logging.getLogger(__name__)
 
+# OSes the manager works with when none are given
+DEFAULT_SUPPORTED_OS = ('nxos', 'iosxe', 'iosxr', 'ios')
+
+# show commands listing the ipv4 address of every interface of a device
+IPV4_SHOW_COMMANDS = {
+    'ios': 'show ip interface',
+    'iosxe': 'show ip interface',
+    'nxos': 'show ip interface vrf all',
+    'iosxr': 'show ipv4 vrf all interface',
+}
+
+def _signature(value):
+    '''Hashable representation of a yaml value, two equal credentials or
+    proxies have the same signature
+    '''
+    return json.dumps(value, sort_keys=True, default=str)
+
+class NeighborResult(object):
+    '''cdp and lldp neighbor data found on a device
+
+    Args:
+        name ('str'): name of the device
+        cdp ('dict'): cdp neighbors parser data
+        lldp ('dict'): lldp neighbors parser data
+        errors ('dict'): error of every discovery step that failed on the
+                         device, {step: error}
+    '''
+    __slots__ = ('name', 'cdp', 'lldp', 'errors')
+
+    def __init__(self, name, cdp, lldp, errors=None):
+        self.name = name
+        self.cdp = cdp
+        self.lldp = lldp
+        self.errors = errors or {}
+
+    def __repr__(self):
+        return '{}(name={!r}, cdp={!r}, lldp={!r}, errors={!r})'.format(
+            self.__class__.__name__, self.name, self.cdp, self.lldp, self.errors)
+
 class TestbedManager(object):
     '''Class designed to handle device interactions for connecting devices
        and cdp and lldp
     '''
-    def __init__(self, testbed, supported_os, config=False, ssh_only=False, alias_dict={},
-                 timeout=10, logfile = '', disable_config=False):
+    def __init__(self, testbed, supported_os=None, config=False, ssh_only=False, alias_dict=None,
+                 timeout=10, logfile = '', disable_config=False, concurrent_logins=None,
+                 verify_cache_ttl=60):
 
         self.config = config
         self.ssh_only = ssh_only
         self.testbed = testbed
-        self.alias_dict = alias_dict
+        self.alias_dict = alias_dict or {}
         self.timeout = int(timeout)
+        # guards the device sets and the verify cache, they are updated
+        # from the worker threads
+        self._state_lock = threading.RLock()
         self.cdp_configured = set()
         self.lldp_configured = set()
         self.visited_devices = set()
-        self.supported_os = supported_os
+        # {(device name, protocol): (state, monotonic deadline)}
+        self._verify_cache = {}
+        self.verify_cache_ttl = verify_cache_ttl
+        self.supported_os = frozenset(supported_os or DEFAULT_SUPPORTED_OS)
         self.logfile = logfile
+        # optional cap on the logins in progress at the same time, for devices
+        # reached through a shared ssh server (jump host) whose MaxStartups
+        # drops the unauthenticated sessions past its limit
+        if concurrent_logins is not None:
+            concurrent_logins = int(concurrent_logins)
+            if concurrent_logins < 1:
+                raise ValueError('concurrent_logins must be at least 1, '
+                                 'got {}'.format(concurrent_logins))
+        self.concurrent_logins = concurrent_logins
+        # built by connect_all_devices for each connection round
+        self._login_semaphore = None
         if disable_config:
             self.disable_config = []
         else:
             self.disable_config = None
+        # thread pool shared by every phase, created by the first phase that
+        # needs it so the workers reuse the connections of this process
+        self._executor = None
+        self._executor_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''Shuts down the thread pool used to work on the devices
+        '''
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._executor_size = 0
+
+    def _mark(self, bucket, name):
+        '''Adds the device name to one of the device sets of the manager
+
+        Args:
+            bucket ('set'): device set to update
+            name ('str'): name of the device
+        '''
+        with self._state_lock:
+            bucket.add(name)
+
+    def _remember_state(self, name, protocol, state):
+        '''Caches the state of the protocol on the device for
+        verify_cache_ttl seconds
+
+        Args:
+            name ('str'): name of the device
+            protocol ('str'): protocol of the state, cdp or lldp
+            state ('bool'): state of the protocol on the device
+        '''
+        with self._state_lock:
+            self._verify_cache[(name, protocol)] = (
+                state, time.monotonic() + self.verify_cache_ttl)
+
+    def _forget_state(self, name, *protocols):
+        '''Drops the cached verification of the protocols on the device
+
+        Args:
+            name ('str'): name of the device
+            protocols ('str'): protocols to drop, cdp or lldp
+        '''
+        with self._state_lock:
+            for protocol in protocols:
+                self._verify_cache.pop((name, protocol), None)
+
+    def _get_executor(self, limit):
+        '''Returns the shared thread pool, the pool is re-created when more
+        workers than it has are needed
+
+        Args:
+            limit ('int'): number of workers needed
+        '''
+        limit = max(int(limit), 1)
+        if self._executor is None or limit > self._executor_size:
+            self.close()
+            self._executor = ThreadPoolExecutor(max_workers = limit)
+            self._executor_size = limit
+        return self._executor
+
+    def _map(self, method, devices, *args):
+        '''Runs the method on every device in parallel using the shared
+        thread pool
+
+        Args:
+            method ('function'): method taking a device as argument
+            devices ('list'): devices to run the method on
+            args ('list'): extra arguments of the method, one list per
+                           argument in the order of the devices
+
+        Returns:
+            list of the method results, in the order of the devices
+        '''
+        devices = list(devices)
+        if not devices:
+            return []
+        return list(self._get_executor(len(devices)).map(method, devices, *args))
 
     def connect_all_devices(self, limit):
-        '''Creates a ThreadPoolExecutor designed to connect to each device in parallel
+        '''Uses the shared thread pool to connect to each device in parallel
         after it takes the connection results of the objects and sorts them into three
         sets for logging purposes
 
         Args:
-            limit ('int'): max number of threads to spawn
+            limit ('int'): min number of threads in the pool, when concurrent_logins
+                           is set the number of logins in progress at the same
+                           time is also bounded by it
             
         Returns:
             three sets for devices that were connected, failed to connect to, and skipped
@@ -48,22 +196,40 @@ class TestbedManager(object):
         fail = set()
         skip = set()
         
-        # Set up a thread pool executor to connect to all devices at the same time
-        with ThreadPoolExecutor(max_workers = limit) as executor:
-            for device_name, device_obj in self.testbed.devices.items():
-                # If already connected or device has already been visited skip
-                if device_obj.connected or device_name in self.visited_devices:
-                    continue
-                if device_obj.os not in self.supported_os:
-                    log.debug('     Device {} does not have valid os, skipping'.format(device_name))
-                    skip.add(device_name)
-                    continue
-                log.debug('     Attempting to connect to {device}'.format(device=device_name))
-                results[device_name] = executor.submit(self._connect_one_device,
-                                                       device_name)
-        
-        for name, exe in results.items():
-            if exe.result():
+        # Logins are staged in waves of at most concurrent_logins if it is set
+        if self.concurrent_logins:
+            self._login_semaphore = threading.BoundedSemaphore(
+                max(1, min(limit, self.concurrent_logins)))
+        else:
+            self._login_semaphore = None
+
+        visited = self.visited_devices
+        supported_os = self.supported_os
+
+        # Use the thread pool executor to connect to all devices at the same time
+        executor = self._get_executor(limit)
+        for device_name, device_obj in self.testbed.devices.items():
+            # If already connected or device has already been visited skip
+            if device_obj.connected or device_name in visited:
+                continue
+            if device_obj.os not in supported_os:
+                log.debug('     Device %s does not have valid os, skipping', device_name)
+                skip.add(device_name)
+                continue
+            log.debug('     Attempting to connect to %s', device_name)
+            results[executor.submit(self._connect_one_device,
+                                    device_name)] = device_name
+
+        # Collect the results as each connection finishes, an exception
+        # raised by one device only marks that device as failed
+        for future in as_completed(results):
+            name = results[future]
+            try:
+                connected = future.result()
+            except Exception as e:
+                log.debug('     Exception connecting to %s: %s', name, e)
+                connected = False
+            if connected:
                 success.add(name)
             else:
                 fail.add(name)
@@ -86,96 +252,81 @@ class TestbedManager(object):
         else:
             to_stdout = False
             
+        dev = self.testbed.devices[device]
+        conns = dev.connections
+        alias = self.alias_dict.get(device)
+
         # if there is a preferred alias for the device, attempt to connect with device
         # using that alias, if the attempt fails or the alias doesn't exist, it will
         # attempt to connect with the default
-        if device in self.alias_dict:
-            if self.alias_dict[device] in self.testbed.devices[device].connections:
-                log.debug('     Attempting to connect to {} with alias {}'.format(device, self.alias_dict[device]))
+        if alias is not None:
+            if alias in conns:
+                log.debug('     Attempting to connect to %s with alias %s', device, alias)
                 try:
-                    self.testbed.devices[device].connect(via = str(self.alias_dict[device]),
-                                                         connection_timeout=self.timeout,
-                                                         log_stdout=to_stdout,
-                                                         logfile = self.logfile,
-                                                         learn_os = True,
-                                                         init_config_commands = self.disable_config)
-                    log.debug('     Connected to device {}'.format(device))
+                    self._login(dev, alias, to_stdout)
+                    log.debug('     Connected to device %s', device)
                 except Exception as e:
-                    log.debug('     Failed to connect to {} with alias {}'.format(device, self.alias_dict[device]))
-                    self.testbed.devices[device].destroy(str(self.alias_dict[device]))
+                    log.debug('     Failed to connect to %s with alias %s: %s', device, alias, e)
+                    dev.destroy(str(alias))
                 else:
                     
                     # No exception raised - get out
-                    return self.testbed.devices[device].connected
+                    return dev.connected
             else:
-                log.debug('     Device {} does not have a connection with alias {}'.format(device, self.alias_dict[device]))
-
-        # Use default - Go through all connection on the device
-        for one_connect in self.testbed.devices[device].connections:
-            # if ssh_only is not enabled try to connect through all connections
-            if one_connect == 'defaults':
-                continue
-            if not self.ssh_only:
-                try:
-                    self.testbed.devices[device].connect(via = str(one_connect),
-                                                         connection_timeout=self.timeout,
-                                                         log_stdout=to_stdout,
-                                                         logfile = self.logfile,
-                                                         learn_os = True,
-                                                         init_config_commands = self.disable_config)
-                    log.debug('     Connected to device {}'.format(device))
-                    break
-                except Exception as e:
-                    log.debug('     Failed to connect to {name} using connection {conn}'.format(name = device, conn = one_connect))                   
-                    # if connection fails, erase the connection from connection mgr
-                    self.testbed.devices[device].destroy(str(one_connect))
-                continue
+                log.debug('     Device %s does not have a connection with alias %s', device, alias)
+
+        # Use default - Go through all connection on the device, if ssh_only is
+        # enabled only the ssh connections are kept. The ssh connections are
+        # tried first as they are the most likely to succeed
+        candidates = [one_connect for one_connect in conns
+                      if one_connect != 'defaults' and
+                      (not self.ssh_only or conns[one_connect].get('protocol', '') == 'ssh')]
+        candidates.sort(key=lambda one_connect: conns[one_connect].get('protocol', '') != 'ssh')
+        for one_connect in candidates:
+            try:
+                self._login(dev, one_connect, to_stdout)
+                log.debug('     Connected to device %s', device)
+                break
+            except Exception as e:
+                log.debug('     Failed to connect to %s using connection %s: %s', device, one_connect, e)
+                # if connection fails, erase the connection from connection mgr
+                dev.destroy(str(one_connect))
 
-            # if ssh only is enabled, check if the connection protocol is ssh before trying to connect
-            if self.testbed.devices[device].connections[one_connect].get('protocol', '') == 'ssh':
-                try:
-                    self.testbed.devices[device].connect(via=str(one_connect),
-                                                         connection_timeout=self.timeout,
-                                                         log_stdout=to_stdout,
-                                                         logfile = self.logfile,
-                                                         learn_os = True,
-                                                         init_config_commands = self.disable_config)
-                    log.debug('     Connected to device {}'.format(device))
-                    break
-                except Exception as e:
-                    # if connection fails, erase the connection from connection mgr
-                    log.debug('     Failed to connect to {name} using connection {conn}'.format(name = device, conn = one_connect))
-                    self.testbed.devices[device].destroy(str(one_connect))
-        
-        if not self.testbed.devices[device]:
-            log.debug('     Failed to connect to {}'.format(device))
-        return self.testbed.devices[device].connected
+        if not dev.connected:
+            log.debug('     Failed to connect to %s', device)
+        return dev.connected
                 
 
+    def _login(self, device, via, to_stdout):
+        '''Connect to the device through the given connection, when
+        concurrent_logins is set the login semaphore is held for the whole
+        connect (login, os learning and init commands)
+
+        Args:
+            device ('device'): device being connected
+            via ('str'): connection of the device to use
+            to_stdout ('bool'): if the device output is sent to the console
+        '''
+        semaphore = self._login_semaphore
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            device.connect(via = str(via),
+                           connection_timeout=self.timeout,
+                           log_stdout=to_stdout,
+                           logfile = self.logfile,
+                           learn_os = True,
+                           init_config_commands = self.disable_config)
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
     def configure_testbed_cdp_protocol(self):
         ''' Method checks if cdp configuration is necessary for all devices in
-        the testbed and if needed calls the cdp configuration method for the
-        target devices in parallel
+        the testbed and if needed runs the cdp configuration step of the
+        discovery pipeline for the target devices in parallel
         '''
-
-        # Check which device to configure CDP on
-        device_to_configure=[]
-        for device_name, device_obj in self.testbed.devices.items():
-            if device_name in self.visited_devices or device_name in self.cdp_configured or not device_obj.connected or device_obj.os not in self.supported_os:
-                continue
-            device_to_configure.append(device_obj)
-
-        # No device to configure
-        if not device_to_configure:
-            return
-
-        # Configure cdp on these device
-        res = pcall(self.configure_device_cdp_protocol,
-                    device=device_to_configure)
-        for result in res:
-            if result[1]:
-                self.cdp_configured.add(result[0])        
-        
+        self._configure_testbed_protocol('cdp')
 
     def configure_device_cdp_protocol(self, device):
         '''If allowed to edit device configuration enable cdp on the device
@@ -186,46 +337,54 @@ class TestbedManager(object):
         '''
 
         # Check if it is already enabled 
-        if device.api.verify_cdp_in_state(max_time=self.timeout, check_interval=5):
+        if self._check_state_cached(device, 'cdp', device.api.verify_cdp_in_state):
             # Already configured - Get out
             return(device.name, False)
         
-        log.debug('    Configuring cdp protocol for {}'.format(device.name))
+        log.debug('    Configuring cdp protocol for %s', device.name)
         # Configure it
         try:
             device.api.configure_cdp()
         except Exception:
             log.error("     Exception configuring cdp "
-                      "for {device}".format(device=device.name),
-                                              exc_info=True)
+                      "for %s", device.name,
+                      exc_info=log.isEnabledFor(logging.DEBUG))
             return(device.name, False)
         else:
+            # the protocol is now enabled, a later check needs no polling
+            self._remember_state(device.name, 'cdp', True)
             return(device.name, True)
 
-    def configure_testbed_lldp_protocol(self):
-        ''' Method checks if lldp configuration is necessary for all devices in
-        the testbed and if needed calls the cdp configuration method for the
-        target devices in parallel
-        '''
+    def _check_state_cached(self, device, protocol, verifier):
+        '''Verify the state of the protocol on the device, the state is kept
+        for verify_cache_ttl seconds so the device is not polled again
 
-        # Check which device to configure lldp on
-        device_to_configure = []
-        for device_name, device_obj in self.testbed.devices.items():
-            if device_name in self.visited_devices or device_name in self.lldp_configured or not device_obj.connected or device_obj.os not in self.supported_os:
-                continue
-            device_to_configure.append(device_obj)
+        Args:
+            device ('device'): device to verify the protocol on
+            protocol ('str'): name of the protocol, cdp or lldp
+            verifier ('function'): device api verifying the protocol state
 
-        # No device to configure    
-        if not device_to_configure:
-            return
+        Returns:
+            state of the protocol on the device
+        '''
+        key = (device.name, protocol)
+        with self._state_lock:
+            cached = self._verify_cache.get(key)
+        if cached and time.monotonic() < cached[1]:
+            return cached[0]
+
+        state = verifier(max_time=self.timeout, check_interval=5)
+        # the verifier can poll for up to timeout seconds, start the ttl
+        # once it returned
+        self._remember_state(device.name, protocol, state)
+        return state
 
-        # Configure lldp on these device    
-        res = pcall(self.configure_device_lldp_protocol,
-                    device= device_to_configure)
-        for result in res:
-            if result[1]:
-                self.lldp_configured.add(result[0])
-        
+    def configure_testbed_lldp_protocol(self):
+        ''' Method checks if lldp configuration is necessary for all devices in
+        the testbed and if needed runs the lldp configuration step of the
+        discovery pipeline for the target devices in parallel
+        '''
+        self._configure_testbed_protocol('lldp')
 
     def configure_device_lldp_protocol(self, device):
         '''If allowed to edit device configuration enable lldp on the device
@@ -236,81 +395,204 @@ class TestbedManager(object):
         '''
 
         # Check if it is already enabled 
-        if device.api.verify_lldp_in_state(max_time= self.timeout, check_interval=5):
+        if self._check_state_cached(device, 'lldp', device.api.verify_lldp_in_state):
             # Already configured - Get out
             return(device.name, False)
         
-        log.debug('     Configuring lldp protocol for {}'.format(device.name))
+        log.debug('     Configuring lldp protocol for %s', device.name)
         # Configure it
         try:
             device.api.configure_lldp()
         except Exception:
             log.error("     Exception configuring lldp "
-                      "for {device}".format(device=device.name),
-                      exc_info=True)
+                      "for %s", device.name,
+                      exc_info=log.isEnabledFor(logging.DEBUG))
             return(device.name, False)
         else:
+            # the protocol is now enabled, a later check needs no polling
+            self._remember_state(device.name, 'lldp', True)
             return(device.name, True)
 
+    def _configure_testbed_protocol(self, protocol):
+        '''Runs the configuration step of the discovery pipeline for one
+        protocol on the connected devices that still need it
+
+        Args:
+            protocol ('str'): protocol to configure, cdp or lldp
+        '''
+        configured = getattr(self, protocol + '_configured')
+
+        # Check which device to configure the protocol on, only the devices
+        # neither visited nor configured yet are looked at
+        devices = self.testbed.devices
+        with self._state_lock:
+            candidates = set(devices) - self.visited_devices - configured
+
+        # No device to configure
+        if not candidates:
+            return
+
+        supported_os = self.supported_os
+        device_to_configure = []
+        for device_name, device_obj in devices.items():
+            if device_name not in candidates or not device_obj.connected or device_obj.os not in supported_os:
+                continue
+            device_to_configure.append(device_obj)
+
+        if not device_to_configure:
+            return
+
+        # Configure the protocol on these device
+        res = self._map(functools.partial(self._configure_step,
+                                          protocols=(protocol,)),
+                        device_to_configure)
+        for result in res:
+            if result[protocol + '_configured']:
+                self._mark(configured, result['name'])
+
     def get_neigbor_data(self):
-        '''Takes a testbed and processes the cdp and lldp data of every
-        device on the testbed that has not yet been visited
+        '''Takes a testbed and runs the discovery pipeline on every device
+        on the testbed that has not yet been visited, cdp and lldp are
+        configured first when config is enabled
 
         Returns:
-            [{device:{'cdp':DATA, 'lldp':data}, device2:{'cdp':data,'lldp':data}}]
+            [NeighborResult(device, cdp, lldp, errors), NeighborResult(device2, ...)]
         '''
+        # the devices that have not been visited are added to the list of
+        # devices that have been visited, nothing to do when there is none
+        devices = self.testbed.devices
+        with self._state_lock:
+            candidates = set(devices) - self.visited_devices
+            if not candidates:
+                return []
+            self.visited_devices.update(candidates)
+
+        # test the connected candidates with a supported os, in testbed order
         dev_to_test = []
-        dev_to_test_names = set()
-        # if the device has not been visited add it to the list of devices to test
-        # and then add it to list of devices that have been visited
-        for device_name, device_obj in self.testbed.devices.items():
-            if device_name in self.visited_devices:
-                continue
-            self.visited_devices.add(device_name)
-            if device_obj.os in self.supported_os and device_obj.connected: 
-                dev_to_test.append(self.testbed.devices[device_name])
-                dev_to_test_names.add(device_name)
-            
-        # use pcall to get cdp and lldp information for all devices in to test list
-        if dev_to_test:
-            result = pcall(self.get_neighbor_info, device = dev_to_test)
-            return result
-        else:
+        supported_os = self.supported_os
+        for device_name, device_obj in devices.items():
+            if device_name in candidates and device_obj.os in supported_os and device_obj.connected:
+                dev_to_test.append(device_obj)
+
+        if not dev_to_test:
             return []
 
+        # run the whole pipeline for all devices in to test list
+        result = []
+        for entry in self._run_pipeline(dev_to_test):
+            if entry['cdp_configured']:
+                self._mark(self.cdp_configured, entry['name'])
+            if entry['lldp_configured']:
+                self._mark(self.lldp_configured, entry['name'])
+            result.append(NeighborResult(entry['name'], entry['cdp'],
+                                         entry['lldp'], entry['errors']))
+        return result
+
+    def _run_pipeline(self, devices, configure=None):
+        '''Runs the discovery steps on the devices: configure cdp and lldp,
+        then get the cdp and lldp neighbors. Each step runs on all the devices
+        in parallel and the neighbors are only collected once every device
+        is configured, so a neighbor enabled late is not missed. A failing
+        step is recorded in the result and does not stop the following ones
+
+        Args:
+            devices ('list'): target devices of the pipeline
+            configure ('bool'): configure cdp and lldp before getting the
+                                neighbors, default to the config attribute
+
+        Returns:
+            [{'name': device name, 'cdp_configured': bool, 'lldp_configured': bool,
+              'cdp': data, 'lldp': data, 'errors': {step: error}}]
+        '''
+        if configure is None:
+            configure = self.config
+
+        if configure:
+            results = self._map(self._configure_step, devices)
+            # give the newly enabled protocols time to exchange their packets,
+            # once for the whole round
+            if any(result['cdp_configured'] or result['lldp_configured']
+                   for result in results):
+                time.sleep(5)
+        else:
+            results = [{'name': device.name,
+                        'cdp_configured': False,
+                        'lldp_configured': False,
+                        'errors': {}} for device in devices]
+
+        self._map(self._collect_step, devices, results)
+        return results
+
+    def _configure_step(self, device, protocols=('cdp', 'lldp')):
+        '''Configuration step of the discovery pipeline, enables the given
+        protocols on the device if they are disabled
+
+        Args:
+            device ('device'): device to configure
+            protocols ('tuple'): protocols to configure, cdp and/or lldp
+
+        Returns:
+            {'name': device name, 'cdp_configured': bool, 'lldp_configured': bool,
+             'errors': {step: error}}
+        '''
+        result = {'name': device.name,
+                  'cdp_configured': False,
+                  'lldp_configured': False,
+                  'errors': {}}
+        for protocol in protocols:
+            method = getattr(self, 'configure_device_{}_protocol'.format(protocol))
+            try:
+                result[protocol + '_configured'] = method(device)[1]
+            except Exception as e:
+                log.error("     Exception configuring %s for %s", protocol, device.name,
+                          exc_info=log.isEnabledFor(logging.DEBUG))
+                result['errors']['configure_' + protocol] = str(e)
+        return result
+
+    def _collect_step(self, device, result):
+        '''Collection step of the discovery pipeline, gets the cdp and lldp
+        neighbors of the device and writes them into the result
+
+        Args:
+            device ('device'): device to get the neighbors of
+            result ('dict'): pipeline result of the device
+        '''
+        result['cdp'] = {}
+        result['lldp'] = {}
+        log.debug('     Getting cdp and lldp neighbor info for %s', device.name)
+        for protocol, method in (('cdp', device.api.get_cdp_neighbors_info),
+                                 ('lldp', device.api.get_lldp_neighbors_info)):
+            try:
+                result[protocol] = method()
+            except Exception as e:
+                log.error("     Exception occurred getting %s info for %s", protocol, device.name,
+                          exc_info=log.isEnabledFor(logging.DEBUG))
+                result['errors'][protocol] = str(e)
+            if result[protocol] is None:
+                log.debug("     No %s information found on %s", protocol.upper(), device.name)
+        log.debug('     Got cdp and lldp neighbor info for %s', device.name)
+
     def get_neighbor_info(self, device):
-        '''Method designed to be used with pcall, gets the devices cdp and lldp
-        neighbor data and then returns it in a dictionary format
+        '''Method designed to be run in parallel on the devices, gets the devices cdp and lldp
+        neighbor data and then returns it as a NeighborResult
 
         Args:
             device ('device'): target to device to call cdp and lldp commands on
         '''
-        cdp = {}
-        lldp = {}
         if device.os not in self.supported_os or not device.connected:
-            return {device.name: {'cdp':cdp, 'lldp':lldp}}
+            return NeighborResult(device.name, {}, {})
 
-        log.debug('     Getting cdp and lldp neighbor info for {}'.format(device.name))
-        
-        # get the devices cdp neighbor information
-        try:
-            cdp = device.api.get_cdp_neighbors_info()
-        except Exception as e:
-            log.error("     Exception occurred getting cdp info for {}".format(device.name))
-            log.debug(e)
-        if cdp is None:
-            log.debug("     No CDP information found on {}".format(device.name))
+        result = {'name': device.name, 'errors': {}}
+        self._collect_step(device, result)
+        return NeighborResult(device.name, result['cdp'], result['lldp'],
+                              result['errors'])
 
-        # get the devices lldp neighbor information
-        try:
-            lldp = device.api.get_lldp_neighbors_info()
-        except Exception as e:
-            log.error("     Exception occurred getting lldp info for {}".format(device.name))
-            log.debug(e)
-        if lldp is None:
-            log.debug("     No LLDP information found on {}".format(device.name))
-        log.debug('     Got cdp and lldp neighbor info for {}'.format(device.name))
-        return {device.name: {'cdp':cdp, 'lldp':lldp}}
+    def unconfigure_testbed_neighbor_discovery_protocols(self):
+        '''Unconfigures the neighbor discovery protocols enabled by the script
+        on all the devices of the testbed in parallel
+        '''
+        self._map(self.unconfigure_neighbor_discovery_protocols,
+                  self.testbed.devices.values())
 
     def unconfigure_neighbor_discovery_protocols(self, device):
         '''Unconfigures neighbor discovery protocols on device if they
@@ -319,20 +601,44 @@ class TestbedManager(object):
         Args:
             device ('device'): device to unconfigure protocols on
         '''
-        log.debug('   Unconfiguring neighbor discovery protocol for {}'.format(device.name))
+        log.debug('   Unconfiguring neighbor discovery protocol for %s', device.name)
+        self._forget_state(device.name, 'cdp', 'lldp')
+        with self._state_lock:
+            cdp_configured = device.name in self.cdp_configured
+            lldp_configured = device.name in self.lldp_configured
+
         # if the device had cdp configured by the script, disable cdp on the device
-        if device.name in self.cdp_configured:
+        if cdp_configured:
             try:
                 device.api.unconfigure_cdp()
             except Exception as e:
-                log.error('     Error unconfiguring cdp on device {}: {}'.format(device.name, e))
+                log.error('     Error unconfiguring cdp on device %s: %s', device.name, e)
 
         # if the device had lldp configured by the script, disable lldp on the device
-        if device.name in self.lldp_configured:
+        if lldp_configured:
             try:
                 device.api.unconfigure_lldp()
             except Exception as e:
-                log.error('     Error unconfiguring lldp on device {}: {}'.format(device.name, e))
+                log.error('     Error unconfiguring lldp on device %s: %s', device.name, e)
+
+    def disconnect_all_devices(self):
+        '''Disconnects every device of the testbed that is still connected
+        so that the sessions opened during the discovery are released
+        '''
+        for device_name, device_obj in self.testbed.devices.items():
+            if not device_obj.connected:
+                continue
+            try:
+                device_obj.disconnect()
+            except Exception as e:
+                log.debug('     Error disconnecting from %s: %s', device_name, e)
+
+    def get_testbed_interfaces_ipV4_address(self):
+        '''Get the ip address for all of the generated interfaces on all the
+        devices of the testbed in parallel
+        '''
+        self._map(self.get_interfaces_ipV4_address,
+                  self.testbed.devices.values())
 
     def get_interfaces_ipV4_address(self, device):
         '''Get the ip address for all of the generated interfaces on the give device
@@ -341,20 +647,68 @@ class TestbedManager(object):
             device ('device'): device to get interface ip addresses for
         '''
         
-        log.debug('   Getting interface ipv4 addresses for {}'.format(device.name))
+        log.debug('   Getting interface ipv4 addresses for %s', device.name)
         # if the device isn't connected or the device doesn't have any interfaces to get ip address for
         if not device.connected or device.os not in self.supported_os or len(device.interfaces) < 1:
             return
+        # every interface already has its address
+        if all(interface.ipv4 is not None for interface in device.interfaces.values()):
+            return
+
+        ip_map = self._bulk_ipv4_map(device) or {}
         for interface in device.interfaces.values():
             if interface.ipv4 is None:
-                try:
-                    ip = device.api.get_interface_ipv4_address(interface.name )
-                except Exception:
-                    ip = None
+                ip = ip_map.get(interface.name)
+                # the interface is missing from the show command output, for
+                # example when its name is written differently, ask for it alone
+                if ip is None:
+                    try:
+                        ip = device.api.get_interface_ipv4_address(interface.name )
+                    except Exception:
+                        ip = None
                 if ip:
                     ip = ipaddress.IPv4Interface(ip)
                     interface.ipv4 = ip
 
+    def _bulk_ipv4_map(self, device):
+        '''Get the ipv4 address of every interface of the device with a single
+        show command instead of one command per interface
+
+        Args:
+            device ('device'): device to get interface ip addresses for
+
+        Returns:
+            {interface name: 'address/prefix length'} or None if the addresses
+            could not be parsed
+        '''
+        command = IPV4_SHOW_COMMANDS.get(device.os)
+        if not command:
+            return None
+        try:
+            output = device.parse(command)
+        except SchemaEmptyParserError:
+            return {}
+        except Exception as e:
+            log.debug('     Could not parse %s on %s: %s', command, device.name, e)
+            return None
+
+        ip_map = {}
+        for interface_name, interface_data in output.items():
+            if not isinstance(interface_data, dict):
+                continue
+            # the ipv4 section also holds keys like counters or mtu, the
+            # addresses are the keys in 'address/prefix length' format
+            ipv4 = interface_data.get('ipv4', {})
+            addresses = [address for address in ipv4
+                         if '/' in address and isinstance(ipv4[address], dict)]
+            # prefer the primary address, fall back to a secondary one when
+            # the interface only has secondary addresses
+            primary = [address for address in addresses
+                       if not ipv4[address].get('secondary')]
+            if primary or addresses:
+                ip_map[interface_name] = (primary or addresses)[0]
+        return ip_map
+
     def get_credentials_and_proxies(self, yaml):
         '''Takes a copy of the current credentials in the testbed for use in
         connecting to other devices
@@ -366,22 +720,26 @@ class TestbedManager(object):
             dict of credentials used in connections
             list of proxies used by testbed devices
         '''
+        devices = yaml['devices'].values()
+
+        # get all credentials used in the testbed, a credential whose name is
+        # already taken is renamed unless the same credential was already seen
         credential_dict = {}
-        proxy_list = []
-        for device in yaml['devices'].values():
-            
-            # get all connections used in the testbed
-            if 'credentials' in device:
-                for cred in device['credentials']:
-                    if cred not in credential_dict :
-                        credential_dict[cred] = dict(device['credentials'][cred])
-                    elif device['credentials'][cred] not in credential_dict.values():
-                        credential_dict[cred + str(len(credential_dict))] = dict(device['credentials'][cred])
-
-            # get list of proxies used in connections
-            for connect in device['connections'].values():
-                if 'proxy' in connect:
-                    if connect['proxy'] not in proxy_list:
-                        proxy_list.append(connect['proxy'])
+        seen_creds = set()
+        for device in devices:
+            for cred, value in (device.get('credentials') or {}).items():
+                signature = _signature(value)
+                if cred not in credential_dict:
+                    credential_dict[cred] = dict(value)
+                elif signature not in seen_creds:
+                    credential_dict[cred + str(len(credential_dict))] = dict(value)
+                seen_creds.add(signature)
+
+        # get list of proxies used in connections, in order of first use
+        proxies = OrderedDict((_signature(connect['proxy']), connect['proxy'])
+                              for device in devices
+                              for connect in device['connections'].values()
+                              if 'proxy' in connect)
+        proxy_list = list(proxies.values())
 
         return credential_dict, proxy_list
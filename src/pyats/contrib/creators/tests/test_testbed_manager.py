@@ -0,0 +1,514 @@
+import time
+import threading
+import ipaddress
+from unittest import TestCase, main, mock
+from collections import OrderedDict
+
+from genie.metaparser.util.exceptions import SchemaEmptyParserError
+from pyats.contrib.creators.libs.testbed_manager import TestbedManager
+
+SUPPORTED_OS = {'ios', 'iosxe', 'nxos', 'iosxr'}
+
+class TestBulkIpv4Map(TestCase):
+
+    def setUp(self):
+        self.manager = TestbedManager(testbed=mock.Mock(), supported_os=SUPPORTED_OS)
+
+    def _device(self, os, output):
+        device = mock.Mock()
+        device.name = 'R1'
+        device.os = os
+        if isinstance(output, Exception):
+            device.parse.side_effect = output
+        else:
+            device.parse.return_value = output
+        return device
+
+    def test_ios(self):
+        output = {
+            'GigabitEthernet1': {
+                'enabled': True,
+                'ipv4': {
+                    '10.0.0.1/24': {'ip': '10.0.0.1', 'prefix_length': '24',
+                                    'secondary': False},
+                },
+            },
+            'GigabitEthernet2': {
+                'enabled': False,
+            },
+        }
+        for os in ('ios', 'iosxe'):
+            device = self._device(os, output)
+            self.assertEqual(self.manager._bulk_ipv4_map(device),
+                             {'GigabitEthernet1': '10.0.0.1/24'})
+            device.parse.assert_called_once_with('show ip interface')
+
+    def test_nxos(self):
+        output = {
+            'Ethernet1/1': {
+                'vrf': 'default',
+                'ipv4': {
+                    'counters': {'unicast_packets_sent': 10},
+                    '10.1.1.1/24': {'ip': '10.1.1.1', 'prefix_length': '24',
+                                    'secondary': True},
+                    '10.2.2.2/24': {'ip': '10.2.2.2', 'prefix_length': '24',
+                                    'secondary': False},
+                },
+            },
+        }
+        device = self._device('nxos', output)
+        self.assertEqual(self.manager._bulk_ipv4_map(device),
+                         {'Ethernet1/1': '10.2.2.2/24'})
+        device.parse.assert_called_once_with('show ip interface vrf all')
+
+    def test_iosxr(self):
+        output = {
+            'GigabitEthernet0/0/0/0': {
+                'vrf': 'default',
+                'ipv4': {
+                    'mtu': 1514,
+                    'unnumbered': {'unnumbered_intf_ref': 'Loopback0'},
+                    '10.3.3.3/24': {'ip': '10.3.3.3', 'prefix_length': '24',
+                                    'secondary': True},
+                },
+            },
+            'GigabitEthernet0/0/0/1': {
+                'vrf': 'default',
+                'ipv4': {'mtu': 1514},
+            },
+        }
+        device = self._device('iosxr', output)
+        self.assertEqual(self.manager._bulk_ipv4_map(device),
+                         {'GigabitEthernet0/0/0/0': '10.3.3.3/24'})
+        device.parse.assert_called_once_with('show ipv4 vrf all interface')
+
+    def test_empty_output(self):
+        device = self._device('nxos', SchemaEmptyParserError('empty'))
+        self.assertEqual(self.manager._bulk_ipv4_map(device), {})
+
+    def test_parse_failure(self):
+        device = self._device('iosxe', Exception('no parser'))
+        self.assertIsNone(self.manager._bulk_ipv4_map(device))
+
+    def test_unsupported_os(self):
+        device = self._device('junos', {})
+        self.assertIsNone(self.manager._bulk_ipv4_map(device))
+        device.parse.assert_not_called()
+
+class TestInterfacesIpv4Address(TestCase):
+
+    def setUp(self):
+        self.manager = TestbedManager(testbed=mock.Mock(), supported_os=SUPPORTED_OS)
+        self.device = mock.Mock()
+        self.device.name = 'R1'
+        self.device.os = 'iosxe'
+        self.device.connected = True
+        self.device.interfaces = OrderedDict()
+        for name, ipv4 in (('GigabitEthernet1', None),
+                           ('GigabitEthernet2', None),
+                           ('GigabitEthernet3', ipaddress.IPv4Interface('10.0.3.1/24'))):
+            interface = mock.Mock()
+            interface.name = name
+            interface.ipv4 = ipv4
+            self.device.interfaces[name] = interface
+        self.device.api.get_interface_ipv4_address.return_value = '10.0.2.1/24'
+
+    def _ipv4(self, name):
+        return self.device.interfaces[name].ipv4
+
+    def test_fallback_for_missing_interfaces(self):
+        self.manager._bulk_ipv4_map = mock.Mock(
+            return_value={'GigabitEthernet1': '10.0.1.1/24'})
+        self.manager.get_interfaces_ipV4_address(self.device)
+
+        self.assertEqual(self._ipv4('GigabitEthernet1'),
+                         ipaddress.IPv4Interface('10.0.1.1/24'))
+        self.assertEqual(self._ipv4('GigabitEthernet2'),
+                         ipaddress.IPv4Interface('10.0.2.1/24'))
+        self.assertEqual(self._ipv4('GigabitEthernet3'),
+                         ipaddress.IPv4Interface('10.0.3.1/24'))
+        self.device.api.get_interface_ipv4_address.assert_called_once_with(
+            'GigabitEthernet2')
+
+    def test_fallback_on_parse_failure(self):
+        self.manager._bulk_ipv4_map = mock.Mock(return_value=None)
+        self.manager.get_interfaces_ipV4_address(self.device)
+
+        self.assertEqual(
+            self.device.api.get_interface_ipv4_address.call_args_list,
+            [mock.call('GigabitEthernet1'), mock.call('GigabitEthernet2')])
+
+    def test_api_failure_leaves_interface_empty(self):
+        self.manager._bulk_ipv4_map = mock.Mock(return_value={})
+        self.device.api.get_interface_ipv4_address.side_effect = Exception('no api')
+        self.manager.get_interfaces_ipV4_address(self.device)
+
+        self.assertIsNone(self._ipv4('GigabitEthernet1'))
+        self.assertIsNone(self._ipv4('GigabitEthernet2'))
+
+def _old_credentials_and_proxies(yaml):
+    '''Reference implementation using the former .values() and list
+    membership scans
+    '''
+    credential_dict = {}
+    proxy_list = []
+    for device in yaml['devices'].values():
+        if 'credentials' in device:
+            for cred in device['credentials']:
+                if cred not in credential_dict:
+                    credential_dict[cred] = dict(device['credentials'][cred])
+                elif device['credentials'][cred] not in credential_dict.values():
+                    credential_dict[cred + str(len(credential_dict))] = dict(device['credentials'][cred])
+        for connect in device['connections'].values():
+            if 'proxy' in connect:
+                if connect['proxy'] not in proxy_list:
+                    proxy_list.append(connect['proxy'])
+    return credential_dict, proxy_list
+
+class TestCredentialsAndProxies(TestCase):
+
+    def setUp(self):
+        self.manager = TestbedManager(testbed=mock.Mock(), supported_os=SUPPORTED_OS)
+        self.yaml = {
+            'devices': {
+                'R1': {
+                    'credentials': {
+                        'default': {'username': 'admin', 'password': 'cisco'},
+                        'enable': {'password': 'cisco'},
+                    },
+                    'connections': {
+                        'cli': {'protocol': 'ssh', 'ip': '10.0.0.1',
+                                'proxy': 'jumphost'},
+                    },
+                },
+                'R2': {
+                    # same credential with its keys in another order
+                    'credentials': {
+                        'default': {'password': 'cisco', 'username': 'admin'},
+                    },
+                    'connections': {
+                        'cli': {'protocol': 'ssh', 'ip': '10.0.0.2',
+                                'proxy': [{'device': 'jumphost'},
+                                          {'device': 'R1'}]},
+                        'vty': {'protocol': 'telnet', 'ip': '10.0.0.2',
+                                'proxy': 'jumphost'},
+                    },
+                },
+                'R3': {
+                    # name clash with a different credential
+                    'credentials': {
+                        'default': {'username': 'other', 'password': 'secret'},
+                    },
+                    'connections': {
+                        'cli': {'protocol': 'ssh', 'ip': '10.0.0.3',
+                                'proxy': [{'device': 'jumphost'},
+                                          {'device': 'R1'}]},
+                    },
+                },
+                'R4': {
+                    'connections': {
+                        'cli': {'protocol': 'ssh', 'ip': '10.0.0.4'},
+                    },
+                },
+            },
+        }
+
+    def test_deduplication(self):
+        credential_dict, proxy_list = \
+            self.manager.get_credentials_and_proxies(self.yaml)
+
+        self.assertEqual(credential_dict, {
+            'default': {'username': 'admin', 'password': 'cisco'},
+            'enable': {'password': 'cisco'},
+            'default2': {'username': 'other', 'password': 'secret'},
+        })
+        self.assertEqual(proxy_list, ['jumphost',
+                                      [{'device': 'jumphost'},
+                                       {'device': 'R1'}]])
+
+    def test_matches_former_implementation(self):
+        self.assertEqual(self.manager.get_credentials_and_proxies(self.yaml),
+                         _old_credentials_and_proxies(self.yaml))
+
+def _testbed(*devices):
+    testbed = mock.Mock()
+    testbed.devices = OrderedDict()
+    for name, os, connected in devices:
+        device = mock.Mock()
+        device.name = name
+        device.os = os
+        device.connected = connected
+        testbed.devices[name] = device
+    return testbed
+
+class TestDeviceSelection(TestCase):
+
+    def setUp(self):
+        self.testbed = _testbed(('R1', 'iosxe', True), ('R2', 'nxos', False),
+                                ('R3', 'junos', True), ('R4', 'iosxr', True))
+        self.manager = TestbedManager(testbed=self.testbed,
+                                      supported_os=SUPPORTED_OS)
+        self.manager._map = mock.Mock(return_value=[])
+
+    def test_neighbor_data_selects_unvisited_devices(self):
+        self.manager.visited_devices.add('R4')
+        self.manager._run_pipeline = mock.Mock(return_value=[])
+        self.manager.get_neigbor_data()
+
+        self.manager._run_pipeline.assert_called_once_with(
+            [self.testbed.devices['R1']])
+        self.assertEqual(self.manager.visited_devices,
+                         {'R1', 'R2', 'R3', 'R4'})
+
+    def test_neighbor_data_all_visited(self):
+        self.manager.visited_devices.update(self.testbed.devices)
+        self.assertEqual(self.manager.get_neigbor_data(), [])
+        self.manager._map.assert_not_called()
+
+    def test_configure_skips_configured_devices(self):
+        self.manager.cdp_configured.update({'R1', 'R4'})
+        self.manager.configure_testbed_cdp_protocol()
+        self.manager._map.assert_not_called()
+
+        self.manager.configure_testbed_lldp_protocol()
+        method, devices = self.manager._map.call_args[0]
+        self.assertEqual(method.keywords, {'protocols': ('lldp',)})
+        self.assertEqual(devices, [self.testbed.devices['R1'],
+                                   self.testbed.devices['R4']])
+
+class TestPipelineOrdering(TestCase):
+
+    def setUp(self):
+        self.testbed = _testbed(('R1', 'iosxe', True), ('R2', 'nxos', True),
+                                ('R3', 'iosxr', True))
+        self.manager = TestbedManager(testbed=self.testbed,
+                                      supported_os=SUPPORTED_OS, config=True)
+        self.events = []
+        self.lock = threading.Lock()
+        # the test patches time.sleep, keep the real one for the fake devices
+        delay = time.sleep
+
+        def record(event):
+            with self.lock:
+                self.events.append(event)
+
+        def configure(device):
+            # R1 is the slowest device to configure
+            if device.name == 'R1':
+                delay(0.2)
+            record(('configure', device.name))
+            return device.name, True
+
+        for device in self.testbed.devices.values():
+            device.api.get_cdp_neighbors_info.side_effect = \
+                lambda name=device.name: record(('collect', name)) or {}
+            device.api.get_lldp_neighbors_info.return_value = {}
+        self.manager.configure_device_cdp_protocol = mock.Mock(side_effect=configure)
+        self.manager.configure_device_lldp_protocol = mock.Mock(
+            side_effect=lambda device: (device.name, False))
+
+    def tearDown(self):
+        self.manager.close()
+
+    def test_collect_after_every_configure(self):
+        with mock.patch('pyats.contrib.creators.libs.testbed_manager.time.sleep') as sleep:
+            result = self.manager.get_neigbor_data()
+
+        steps = [step for step, _ in self.events]
+        self.assertEqual(steps, ['configure'] * 3 + ['collect'] * 3)
+        sleep.assert_called_once_with(5)
+        self.assertEqual([entry.name for entry in result], ['R1', 'R2', 'R3'])
+        self.assertEqual(self.manager.cdp_configured, {'R1', 'R2', 'R3'})
+        self.assertEqual(self.manager.lldp_configured, set())
+
+    def test_no_settle_delay_without_changes(self):
+        self.manager.configure_device_cdp_protocol.side_effect = \
+            lambda device: (device.name, False)
+        with mock.patch('pyats.contrib.creators.libs.testbed_manager.time.sleep') as sleep:
+            self.manager.get_neigbor_data()
+        sleep.assert_not_called()
+
+class TestVerifyCache(TestCase):
+
+    def setUp(self):
+        self.testbed = _testbed(('R1', 'iosxe', True))
+        self.device = self.testbed.devices['R1']
+        self.manager = TestbedManager(testbed=self.testbed,
+                                      supported_os=SUPPORTED_OS,
+                                      verify_cache_ttl=60)
+        self.addCleanup(self.manager.close)
+        self.verifier = mock.Mock(return_value=True)
+        patcher = mock.patch(
+            'pyats.contrib.creators.libs.testbed_manager.time.monotonic')
+        self.monotonic = patcher.start()
+        self.monotonic.return_value = 100
+        self.addCleanup(patcher.stop)
+
+    def test_hit(self):
+        for _ in range(2):
+            self.assertTrue(self.manager._check_state_cached(
+                self.device, 'cdp', self.verifier))
+        self.verifier.assert_called_once_with(max_time=10, check_interval=5)
+
+    def test_expiry(self):
+        self.manager._check_state_cached(self.device, 'cdp', self.verifier)
+        self.monotonic.return_value = 159
+        self.manager._check_state_cached(self.device, 'cdp', self.verifier)
+        self.assertEqual(self.verifier.call_count, 1)
+
+        self.monotonic.return_value = 160
+        self.manager._check_state_cached(self.device, 'cdp', self.verifier)
+        self.assertEqual(self.verifier.call_count, 2)
+
+    def test_ttl_starts_after_verification(self):
+        def verify(**kwargs):
+            # the verifier polls the device for 30 seconds
+            self.monotonic.return_value += 30
+            return True
+
+        self.verifier.side_effect = verify
+        self.manager._check_state_cached(self.device, 'lldp', self.verifier)
+        self.monotonic.return_value = 189
+        self.manager._check_state_cached(self.device, 'lldp', self.verifier)
+        self.assertEqual(self.verifier.call_count, 1)
+
+    def test_unconfigure_invalidates(self):
+        self.manager._check_state_cached(self.device, 'cdp', self.verifier)
+        self.manager._check_state_cached(self.device, 'lldp', self.verifier)
+        self.manager.unconfigure_neighbor_discovery_protocols(self.device)
+
+        self.manager._check_state_cached(self.device, 'cdp', self.verifier)
+        self.manager._check_state_cached(self.device, 'lldp', self.verifier)
+        self.assertEqual(self.verifier.call_count, 4)
+
+    def test_configure_then_pipeline_reuses_state(self):
+        self.device.api.verify_cdp_in_state.return_value = False
+        self.device.api.verify_lldp_in_state.return_value = False
+        self.manager.configure_testbed_cdp_protocol()
+        self.device.api.configure_cdp.assert_called_once_with()
+        self.assertEqual(self.manager.cdp_configured, {'R1'})
+
+        # the configuration step of the pipeline finds cdp enabled without
+        # polling the device again
+        result = self.manager._configure_step(self.device)
+        self.assertFalse(result['cdp_configured'])
+        self.assertTrue(result['lldp_configured'])
+        self.device.api.verify_cdp_in_state.assert_called_once_with(
+            max_time=10, check_interval=5)
+        self.device.api.configure_cdp.assert_called_once_with()
+
+class TestConnectAllDevices(TestCase):
+
+    def setUp(self):
+        self.testbed = _testbed(('R1', 'iosxe', False), ('R2', 'nxos', False),
+                                ('R3', 'iosxr', False), ('R4', 'junos', False),
+                                ('R5', 'ios', True))
+        self.manager = TestbedManager(testbed=self.testbed,
+                                      supported_os=SUPPORTED_OS)
+        self.addCleanup(self.manager.close)
+
+        def connect(name):
+            if name == 'R2':
+                raise Exception('worker crashed')
+            return name == 'R1'
+
+        self.manager._connect_one_device = mock.Mock(side_effect=connect)
+
+    def test_results(self):
+        success, fail, skip = self.manager.connect_all_devices(4)
+
+        self.assertEqual(success, {'R1'})
+        self.assertEqual(fail, {'R2', 'R3'})
+        self.assertEqual(skip, {'R4'})
+        self.assertEqual(sorted(call[0][0] for call in
+                                self.manager._connect_one_device.call_args_list),
+                         ['R1', 'R2', 'R3'])
+
+    def test_visited_devices_skipped(self):
+        self.manager.visited_devices.update({'R1', 'R2'})
+        success, fail, skip = self.manager.connect_all_devices(4)
+
+        self.assertEqual(success, set())
+        self.assertEqual(fail, {'R3'})
+        self.assertEqual(skip, {'R4'})
+
+class TestConnectOneDevice(TestCase):
+
+    def setUp(self):
+        self.testbed = _testbed(('R1', 'iosxe', False))
+        self.device = self.testbed.devices['R1']
+        self.device.connections = OrderedDict([
+            ('defaults', {'class': 'unicon.Unicon'}),
+            ('telnet', {'protocol': 'telnet', 'ip': '10.0.0.1'}),
+            ('vty', {'ip': '10.0.0.1'}),
+            ('cli', {'protocol': 'ssh', 'ip': '10.0.0.1'}),
+        ])
+        self.tried = []
+        self.working = set()
+
+    def _manager(self, **kwargs):
+        manager = TestbedManager(testbed=self.testbed,
+                                 supported_os=SUPPORTED_OS, **kwargs)
+
+        def login(device, via, to_stdout):
+            self.tried.append(via)
+            if via not in self.working:
+                raise Exception('cannot connect')
+            device.connected = True
+
+        manager._login = mock.Mock(side_effect=login)
+        return manager
+
+    def test_ssh_first(self):
+        manager = self._manager()
+        self.assertFalse(manager._connect_one_device('R1'))
+        self.assertEqual(self.tried, ['cli', 'telnet', 'vty'])
+        self.assertEqual(self.device.destroy.call_args_list,
+                         [mock.call('cli'), mock.call('telnet'), mock.call('vty')])
+
+    def test_stop_at_first_working_connection(self):
+        self.working.add('telnet')
+        manager = self._manager()
+        self.assertTrue(manager._connect_one_device('R1'))
+        self.assertEqual(self.tried, ['cli', 'telnet'])
+
+    def test_ssh_only(self):
+        self.working.add('telnet')
+        manager = self._manager(ssh_only=True)
+        self.assertFalse(manager._connect_one_device('R1'))
+        self.assertEqual(self.tried, ['cli'])
+
+    def test_alias(self):
+        self.working.update({'telnet', 'cli'})
+        manager = self._manager(alias_dict={'R1': 'telnet'})
+        self.assertTrue(manager._connect_one_device('R1'))
+        self.assertEqual(self.tried, ['telnet'])
+
+    def test_alias_fallback(self):
+        self.working.add('vty')
+        manager = self._manager(alias_dict={'R1': 'telnet'})
+        self.assertTrue(manager._connect_one_device('R1'))
+        self.assertEqual(self.tried, ['telnet', 'cli', 'telnet', 'vty'])
+
+    def test_unknown_alias(self):
+        self.working.add('cli')
+        manager = self._manager(alias_dict={'R1': 'console'})
+        self.assertTrue(manager._connect_one_device('R1'))
+        self.assertEqual(self.tried, ['cli'])
+
+    def test_failure_logged(self):
+        manager = self._manager()
+        with mock.patch('pyats.contrib.creators.libs.testbed_manager.log') as log:
+            self.assertFalse(manager._connect_one_device('R1'))
+        log.debug.assert_any_call('     Failed to connect to %s', 'R1')
+
+    def test_success_not_logged_as_failure(self):
+        self.working.add('cli')
+        manager = self._manager()
+        with mock.patch('pyats.contrib.creators.libs.testbed_manager.log') as log:
+            self.assertTrue(manager._connect_one_device('R1'))
+        self.assertNotIn(mock.call('     Failed to connect to %s', 'R1'),
+                         log.debug.call_args_list)
+
+if __name__ == '__main__':
+    main()
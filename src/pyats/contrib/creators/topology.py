@@ -1,7 +1,6 @@
 import os
 import re
 import sys
-import time
 import logging
 import argparse
 import ipaddress
@@ -13,7 +12,6 @@ from concurrent.futures import ThreadPoolExecutor
 
 from genie.conf import Genie
 from genie.testbed import load
-from pyats.async_ import pcall
 from genie.conf.base import Testbed, Device, Interface, Link
 from genie.metaparser.util.exceptions import SchemaEmptyParserError
 from pyats.log import ScreenHandler
@@ -87,6 +85,9 @@ class Topology(TestbedCreator):
                            made
         disable-config ('bool'): If true, the script will not run config commands on devices that it
                                  connects to
+        concurrent-logins ('int'): max number of device logins in progress at the same time, for
+                                   devices reached through a shared ssh server (jump host)
+                                   default behavior is no limit
 
     CLI Argument                                   |  Class Argument
     --------------------------------------------------------------------------------------------
@@ -104,6 +105,7 @@ class Topology(TestbedCreator):
     --debug-log='<log name>'                       |  debug_log = '<log name>'
     --disable-config                               |  disable_config = True
     --telnet-connect                               |  telnet_connect = True
+    --concurrent-logins=value                      |  concurrent_logins=value
     """
 
     def _init_arguments(self):
@@ -127,7 +129,8 @@ class Topology(TestbedCreator):
                 'cred_prompt': False,
                 'debug_log': '',
                 'disable_config': False,
-                'telnet_connect': False
+                'telnet_connect': False,
+                'concurrent_logins': None
             }
         }
 
@@ -193,7 +196,8 @@ class Topology(TestbedCreator):
                                                  timeout=self._timeout,
                                                  supported_os=SUPPORTED_OS,
                                                  logfile = log_file,
-                                                 disable_config=self._disable_config)
+                                                 disable_config=self._disable_config,
+                                                 concurrent_logins=self._concurrent_logins)
 
         # Get the credential for the device from the yaml - so can recreate the
         # yaml with those
@@ -208,88 +212,94 @@ class Topology(TestbedCreator):
 
         device_list = {}
         count = 1
-        while len(testbed.devices) > len(dev_man.visited_devices):
-            # connect to unvisited devices
-            log.info ('Discovery Process Round {}'.format(count))
-            log.info ('   Connecting to devices')
-
-            log.debug('--------DEBUG LOGS-------')
-            connect, noconnect, skip= dev_man.connect_all_devices(len(testbed.devices))
-            log.debug('--------CONSOLE LOGS--------')
-            if connect:
-                log.info('     Successfully connected to devices {}'.format(connect))
-            if noconnect:
-                log.info('     Failed to connect to devices {}'.format(noconnect))
-            if skip:
-                log.info('     Skipped connecting to devices {}'.format(skip))
+        try:
+            while len(testbed.devices) > len(dev_man.visited_devices):
+                # connect to unvisited devices
+                log.info ('Discovery Process Round {}'.format(count))
+                log.info ('   Connecting to devices')
 
-            # Configure these connected devices
-            if dev_man.config:
-                log.info('   Configuring Testbed devices cdp and lldp protocol')
+                log.debug('--------DEBUG LOGS-------')
+                connect, noconnect, skip= dev_man.connect_all_devices(len(testbed.devices))
+                log.debug('--------CONSOLE LOGS--------')
+                if connect:
+                    log.info('     Successfully connected to devices {}'.format(connect))
+                if noconnect:
+                    log.info('     Failed to connect to devices {}'.format(noconnect))
+                if skip:
+                    log.info('     Skipped connecting to devices {}'.format(skip))
+
+                # Configure these connected devices and get their cdp/lldp operation
+                # data, the data is only collected once every device is configured
+                if dev_man.config:
+                    log.info('   Configuring Testbed devices cdp and lldp protocol')
+                log.info('   Finding neighbors information')
 
                 log.debug('--------DEBUG LOGS-------')
-                dev_man.configure_testbed_cdp_protocol()
-                dev_man.configure_testbed_lldp_protocol()
+                result = dev_man.get_neigbor_data()
                 log.debug('--------CONSOLE LOGS--------')
-                time.sleep(5)
+                for entry in result:
+                    if entry.errors:
+                        log.info('     Failed steps on device {}: {}'.format(
+                                 entry.name, ', '.join(sorted(entry.errors))))
+
+                if dev_man.config:
+                    if dev_man.cdp_configured:
+                        log.info('     cdp was configured for devices {}'.format(dev_man.cdp_configured))
+                    else:
+                        log.info('     cdp was not configured on any device')
+                    if dev_man.lldp_configured:
+                        log.info('     lldp was configured for devices {}'.format(dev_man.lldp_configured))
+                    else:
+                        log.info('     lldp was not configured on any device')
+
+                # Massage the neighbor data into our structure format
+                log.debug('--------DEBUG LOGS-------')
+                connections = self.process_neighbor_data(testbed, device_list,
+                                                         exclude_networks, result)
+                log.debug('Connections found in current set of devices: {}'.format(connections))
 
-                if dev_man.cdp_configured:
-                    log.info('     cdp was configured for devices {}'.format(dev_man.cdp_configured))
-                else:
-                    log.info('     cdp was not configured on any device')
-                if dev_man.lldp_configured:
-                    log.info('     lldp was configured for devices {}'.format(dev_man.lldp_configured))
-                else:
-                    log.info('     lldp was not configured on any device')
+                log.debug('--------DEBUG LOGS-------')
+                device_ip_string = self.format_debug_string(device_list, dev_man)
+                log.debug(device_ip_string)
 
-            # Get the cdp/lldp operation data and massage it into our structure format
-            log.info('   Finding neighbors information')
+                # Create new devices to add to testbed
+                # This make testbed.devices grow, add these new devices
+                new_devs = self._write_devices_into_testbed(device_list, proxy_set,
+                                                            credential_dict, testbed)
+                log.debug('--------CONSOLE LOGS--------')
+                if new_devs:
+                    log.info('     Found these new devices {} - Restarting a new discovery process'.format(new_devs))
 
-            log.debug('--------DEBUG LOGS-------')
-            result = dev_man.get_neigbor_data()
-            connections = self.process_neighbor_data(testbed, device_list,
-                                                     exclude_networks, result)
-            log.debug('Connections found in current set of devices: {}'.format(connections))
 
-            log.debug('--------DEBUG LOGS-------')
-            device_ip_string = self.format_debug_string(device_list, dev_man)
-            log.debug(device_ip_string)
+                # add the connections that were found to the topology
+                self._write_connections_to_testbed(connections, testbed)
+                log.info('')
+                if self._only_links:
+                    break
+                count += 1
 
-            # Create new devices to add to testbed
-            # This make testbed.devices grow, add these new devices
-            new_devs = self._write_devices_into_testbed(device_list, proxy_set,
-                                                        credential_dict, testbed)
+            log.debug('--------DEBUG LOGS-------')
+            # get IP address for interfaces
+            log.debug('Get interface ip addresses')
+            dev_man.get_testbed_interfaces_ipV4_address()
             log.debug('--------CONSOLE LOGS--------')
-            if new_devs:
-                log.info('     Found these new devices {} - Restarting a new discovery process'.format(new_devs))
-
-
-            # add the connections that were found to the topology
-            self._write_connections_to_testbed(connections, testbed)
-            log.info('')
-            if self._only_links:
-                break
-            count += 1
-
-        log.debug('--------DEBUG LOGS-------')
-        # get IP address for interfaces
-        log.debug('Get interface ip addresses')
-        pcall(dev_man.get_interfaces_ipV4_address,
-              device = testbed.devices.values())
-        log.debug('--------CONSOLE LOGS--------')
 
-        # unconfigure cdp and lldp on devices that were configured by script
-        if self._config_discovery:
-            log.info('Unconfiguring cdp and lldp protocols on configured devices')
+            # unconfigure cdp and lldp on devices that were configured by script
+            if self._config_discovery:
+                log.info('Unconfiguring cdp and lldp protocols on configured devices')
 
-            log.debug('--------DEBUG LOGS-------')
-            pcall(dev_man.unconfigure_neighbor_discovery_protocols,
-                  device= testbed.devices.values())
-            log.debug('--------CONSOLE LOGS--------')
-            if dev_man.cdp_configured:
-                log.info('   CDP was unconfigured on {}'.format(dev_man.cdp_configured))
-            if dev_man.lldp_configured:
-                log.info('   LLDP was unconfigured on {}'.format(dev_man.lldp_configured))
+                log.debug('--------DEBUG LOGS-------')
+                dev_man.unconfigure_testbed_neighbor_discovery_protocols()
+                log.debug('--------CONSOLE LOGS--------')
+                if dev_man.cdp_configured:
+                    log.info('   CDP was unconfigured on {}'.format(dev_man.cdp_configured))
+                if dev_man.lldp_configured:
+                    log.info('   LLDP was unconfigured on {}'.format(dev_man.lldp_configured))
+        finally:
+            # release the sessions and the workers used during the discovery,
+            # also when the discovery fails
+            dev_man.disconnect_all_devices()
+            dev_man.close()
 
         # add the new information into testbed_yaml
         final_yaml = self.create_yaml_dict(testbed, testbed_yaml, credential_dict)
@@ -331,7 +341,8 @@ class Topology(TestbedCreator):
             device_list ('list'): list of device with information about how to
                                   connect and their existing interfaces
             exclude_networks ('list'): range of ip addresses whose connections won't be logged in the yaml
-            result ('dict'): cdp and lldp parser data from testbed
+            result ('list'): NeighborResult with the cdp and lldp parser data
+                             of the testbed devices
 
         Returns:
             {device:{interface with connection:{'dest_host': destination device,
@@ -344,9 +355,8 @@ class Topology(TestbedCreator):
         # {device:{interface with connection:{'dest_host': destination device,
         #                                     'dest_port': destination device port}}}
         for entry in result:
-            for device in entry:
-                conn_dict[device] = self.get_device_connections(entry[device],
-                                                                device,
+            conn_dict[entry.name] = self.get_device_connections(entry,
+                                                                entry.name,
                                                                 device_list,
                                                                 exclude_networks,
                                                                 testbed)
@@ -359,7 +369,7 @@ class Topology(TestbedCreator):
         then it processes the lldp information and adds new data to the dict
 
         Args:
-            data ('dict'): dict containing devices cdp and lldp information
+            data ('NeighborResult'): devices cdp and lldp information
             device_name ('str'): the device whose connections are being processed
             device_list ('list'): list of device with information about how to
                                   connect and their existing interfaces
@@ -373,14 +383,14 @@ class Topology(TestbedCreator):
         device_connections = {}
 
         # parse cdp information
-        result = data.get('cdp', [])
+        result = data.cdp
         if result:
             log.debug('   Processing cdp information for {}'.format(device_name))
             self._process_cdp_information(result, device_name, device_list,
                                           exclude_networks , testbed, device_connections)
 
         # parse lldp information
-        result = data.get('lldp', [])
+        result = data.lldp
         if result and result['total_entries'] != 0:
             log.debug('   Processing lldp information for {}'.format(device_name))
             self._process_lldp_information(result, device_name, device_list,